@@ -0,0 +1 @@
+"""EHR segmenters that split a scanned medical-record PDF into records."""
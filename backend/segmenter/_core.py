@@ -0,0 +1,302 @@
+"""Extraction helpers shared by the classic and advanced EHR segmenters."""
+from rapidfuzz import fuzz, process
+from collections import Counter, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, ClassVar, Dict, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+import csv
+import logging
+import os
+import re
+import sys
+import tempfile
+import ahocorasick
+
+logger = logging.getLogger(__name__)
+
+DATE_PATTERNS = {
+    'mdy': r'\d{1,2}/\d{1,2}/\d{4}',  # MM/DD/YYYY
+    'dash': r'\d{1,2}-\d{1,2}-\d{4}',  # MM-DD-YYYY
+    'iso': r'\d{4}-\d{1,2}-\d{1,2}',  # YYYY-MM-DD
+    'mname': r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{1,2},? \d{4}'  # Month DD, YYYY
+}
+
+HEADER_KEYWORDS = ['LABORATORY', 'PROGRESS', 'NOTE', 'REPORT', 'CLINICAL', 'CONSULTATION']
+
+# Cache size for header normalization
+MAX_CACHE_SIZE = 512
+
+# Most pages a worker process extracts per opening of the PDF
+PAGE_BATCH_SIZE = 500
+
+# Output CSV columns, in order; each is an attribute of PageRecord
+CSV_COLUMNS = [
+    'pagenumber', 'category', 'isreviewable', 'dos', 'provider',
+    'referencekey', 'parentkey', 'lockstatus', 'header',
+    'facilitygroup', 'reviewerid', 'qcreviewerid', 'isduplicate'
+]
+
+@dataclass(slots=True)
+class PageRecord:
+    """Metadata extracted from one page, filled in further as pages are grouped."""
+    pagenumber: int
+    text_head: str
+    text_tail: str
+    header: str
+    dos: str
+    provider: str
+    category: Optional[int]
+    # Classic segmenter only: the note/lab category implied by the whole page
+    # text, used when neither the header nor the page start gives a category
+    text_category: Optional[int] = None
+    isreviewable: bool = True
+    parentkey: Optional[int] = None
+    referencekey: Optional[int] = None
+    facilitygroup: str = ''
+
+    # Review columns with the same value on every output row
+    lockstatus: ClassVar[str] = 'L'
+    reviewerid: ClassVar[int] = 287
+    qcreviewerid: ClassVar[int] = 322
+    isduplicate: ClassVar[bool] = False
+
+# Pre-compiled patterns for header normalization
+_CONT_RE = re.compile(r'\s*\(continued\)', re.IGNORECASE)
+_CONT2_RE = re.compile(r'\s*\(cont\.\)', re.IGNORECASE)
+_LABS_RE = re.compile(r'^LABS?\b', re.IGNORECASE)
+_PROG_RE = re.compile(r'^PROG\.?\s*NOTE', re.IGNORECASE)
+
+# All date formats fused into one alternation of named groups so a page is scanned once
+DATE_RE = re.compile(
+    '|'.join(f'(?P<{kind}>{pattern})' for kind, pattern in DATE_PATTERNS.items()),
+    re.IGNORECASE
+)
+
+def build_automaton(words: Iterable[Tuple[str, object]]) -> ahocorasick.Automaton:
+    """Build an Aho-Corasick automaton from (keyword, value) pairs; the first value for a keyword wins."""
+    automaton = ahocorasick.Automaton()
+    for keyword, value in words:
+        if keyword not in automaton:
+            automaton.add_word(keyword, value)
+    automaton.make_automaton()
+    return automaton
+
+def build_category_automaton(category_keywords: Dict[int, List[str]]) -> ahocorasick.Automaton:
+    """Build an automaton over a category keyword table for use with match_category."""
+    # Tag each keyword with its category's position so one scan honours the table order
+    return build_automaton(
+        (keyword, (priority, category))
+        for priority, (category, keywords) in enumerate(category_keywords.items())
+        for keyword in keywords
+    )
+
+def match_category(automaton: ahocorasick.Automaton, text_upper: str) -> Optional[int]:
+    """Return the highest-priority category with a keyword in the uppercased text, if any."""
+    hits = [value for _, value in automaton.iter(text_upper)]
+    return min(hits)[1] if hits else None
+
+# Header keywords plus continuation markers, matched against uppercased lines
+_HEADER_AUTOMATON = build_automaton(
+    (keyword, keyword) for keyword in HEADER_KEYWORDS + ['(CONTINUED)', '(CONT.)']
+)
+
+@lru_cache(maxsize=MAX_CACHE_SIZE)
+def normalize_header(header: str) -> str:
+    """Normalize header by removing continuation markers and standardizing format."""
+    if not header:
+        return ""
+    # Remove continuation markers
+    header = _CONT_RE.sub('', header)
+    header = _CONT2_RE.sub('', header)
+    # Standardize common variations
+    header = _LABS_RE.sub('LABORATORY', header)
+    header = _PROG_RE.sub('PROGRESS NOTE', header)
+    return header.strip()
+
+def extract_header(lines: List[str], prev_header: str = "") -> str:
+    """Extract header from the first 15 of a page's lines, falling back to the previous header."""
+    lines = lines[:15]
+    upper_lines = [line.upper() for line in lines]
+
+    # First pass: look for exact matches
+    head_upper = '\n'.join(upper_lines)
+    for end_index, _ in _HEADER_AUTOMATON.iter(head_upper):
+        # Keywords never span lines, so the first hit lies on the first matching line
+        return lines[head_upper.count('\n', 0, end_index)].strip()
+
+    # Second pass: look for partial matches, scoring all keywords per line in one call
+    for line, line_upper in zip(lines, upper_lines):
+        match = process.extractOne(line_upper, HEADER_KEYWORDS, scorer=fuzz.partial_ratio, score_cutoff=80)
+        if match and match[1] > 80:
+            return line.strip()
+
+    # Fallback to previous header
+    return prev_header if prev_header else ""
+
+def ascii_upper(text: str) -> bytes:
+    """Uppercase text as ASCII bytes, which searches for plain-ASCII keywords faster than str."""
+    return text.encode('ascii', 'replace').upper()
+
+def most_common(values: List, default):
+    """Return the most frequent value (the first seen on ties), or default if there are none."""
+    return Counter(values).most_common(1)[0][0] if values else default
+
+def iter_page_texts(pdf_path: str, page_numbers: range) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) for each page in the range that has text, opening the PDF once."""
+    # pdfplumber is slow to import and only needed once there is a PDF to read
+    import pdfplumber
+    with pdfplumber.open(pdf_path, pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text()
+            # Only the text is needed, so drop the cached chars/lines/rects now
+            page.close()
+            if text:
+                yield page.page_number, text
+
+def _process_page_batch(
+    pdf_path: str, page_numbers: range, process_page: Callable[[int, str], Tuple[str, PageRecord]]
+) -> List[Tuple[str, PageRecord]]:
+    """Extract text and metadata from a batch of pages in a worker process."""
+    return [process_page(page_num, text) for page_num, text in iter_page_texts(pdf_path, page_numbers)]
+
+def map_page_batches(
+    pdf_path: str, process_page: Callable[[int, str], Tuple[str, PageRecord]]
+) -> Iterator[Tuple[str, PageRecord]]:
+    """Run a picklable process_page over the text of each page in worker processes, in page order."""
+    import pdfplumber
+    with pdfplumber.open(pdf_path) as pdf:
+        num_pages = len(pdf.pages)
+
+    workers = os.cpu_count() or 1
+    batch_size = max(1, min(PAGE_BATCH_SIZE, -(-num_pages // workers)))
+    batches = [
+        range(start, min(start + batch_size, num_pages + 1))
+        for start in range(1, num_pages + 1, batch_size)
+    ]
+    # Never start more workers than there are batches, and skip the pool entirely
+    # when it would have a single worker, since starting it costs more than it gains
+    workers = min(workers, len(batches))
+    if workers <= 1:
+        yield from chain.from_iterable(map(_process_page_batch, repeat(pdf_path), batches, repeat(process_page)))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep at most one batch per worker ahead of the consumer, so a slow
+        # consumer holds back extraction instead of buffering the document
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_process_page_batch, pdf_path, batch, process_page))
+            if len(pending) > workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def resolve_header_fallback(
+    results: Iterable[Tuple[str, PageRecord]],
+    normalize: Callable[[str], str],
+    determine_category: Callable[[str, Optional[int]], Optional[int]]
+) -> Iterator[PageRecord]:
+    """Yield the pages of in-order (raw header, page) results, giving headerless pages the previous header."""
+    prev_header = ""
+    for raw_header, page in results:
+        if raw_header:
+            prev_header = raw_header
+        else:
+            # Decide the category from the inherited header and the text's category
+            page.header = normalize(prev_header)
+            page.category = determine_category(page.header, page.category)
+        # Header, DOS and provider repeat across a record's pages, so keep one
+        # shared string per distinct value, like a categorical column
+        page.header = sys.intern(page.header)
+        page.dos = sys.intern(page.dos)
+        page.provider = sys.intern(page.provider)
+        yield page
+
+def write_csv(output_path: str, pages: Iterable[PageRecord]):
+    """Write grouped pages to the output CSV, replacing it only once every row is written."""
+    row = attrgetter(*CSV_COLUMNS)
+    # The pages may still be extracted as rows are written, so write beside the
+    # output and move it into place at the end; a failure leaves no partial CSV
+    fd, tmp_path = tempfile.mkstemp(suffix='.csv', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        # Stream rows straight from the page records; the text never reaches the writer
+        with open(fd, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(CSV_COLUMNS)
+            writer.writerows(map(row, pages))
+        # mkstemp creates the file private; give it the permissions open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info(f"Output CSV generated at: {output_path}")
+
+class BaseSegmenter:
+    """Extraction and output pipeline shared by the segmenters."""
+
+    # Subclasses provide _category_automaton, _determine_by_text, _uncategorized,
+    # a _process_page staticmethod, group_pages and _process_group
+
+    _normalize_header = staticmethod(normalize_header)
+    _extract_header = staticmethod(extract_header)
+
+    def __init__(self, pdf_path: str):
+        self.pdf_path = pdf_path
+        self.pages_data = []
+        self.current_record = None
+
+    def extract_text_from_pdf(self) -> List[PageRecord]:
+        """Extract text and metadata from each page of the PDF."""
+        self.pages_data.extend(self.extract_pages())
+        return self.pages_data
+
+    def extract_pages(self) -> Iterator[PageRecord]:
+        """Yield the metadata of each page of the PDF in page order as it is extracted."""
+        try:
+            # Pages are independent, so extract them in parallel worker processes,
+            # then apply the header fallback, which depends on the previous page, in order
+            results = map_page_batches(self.pdf_path, self._process_page)
+            yield from resolve_header_fallback(results, self._normalize_header, self._determine_inherited_category)
+        except Exception as e:
+            logger.error(f"Error extracting text from PDF: {str(e)}")
+            raise
+
+    @classmethod
+    def _determine_category(cls, header: str, text: str) -> Optional[int]:
+        """Determine the category based on header content and page text."""
+        # Check header first
+        category = cls._determine_by_header(header)
+        if category is None:
+            category = cls._determine_by_text(text[:1000])
+        return category if category is not None else cls._uncategorized(header)
+
+    @classmethod
+    def _determine_inherited_category(cls, header: str, text_category: Optional[int]) -> Optional[int]:
+        """Determine the category of a headerless page from its inherited header and its text's category."""
+        category = cls._determine_by_header(header)
+        if category is None:
+            category = text_category
+        return category if category is not None else cls._uncategorized(header)
+
+    @classmethod
+    @lru_cache(maxsize=MAX_CACHE_SIZE)
+    def _determine_by_header(cls, header: str) -> Optional[int]:
+        """Determine the category from header keywords; headers repeat across a record's pages."""
+        return match_category(cls._category_automaton, header.upper())
+
+    def group_records(self) -> List[PageRecord]:
+        """Group pages into records based on content similarity."""
+        return list(chain.from_iterable(self.group_pages(self.pages_data)))
+
+    def generate_output_csv(self, output_path: str):
+        """Generate the final CSV output."""
+        write_csv(output_path, self.pages_data)
+
+    def segment_to_csv(self, output_path: str):
+        """Extract, group and write the PDF to CSV, holding only the open record and the batches in flight."""
+        write_csv(output_path, chain.from_iterable(self.group_pages(self.extract_pages())))